@@ -1,56 +1,408 @@
 import os
-import json
 import uuid
+import re
 import time
-import boto3
-from urllib.parse import unquote_plus
+import hmac
+import hashlib
+import base64
+import random
+import functools
+import collections
+import concurrent.futures
+import orjson
+from urllib.parse import quote, unquote_plus
 
 IMAGE_BUCKET = os.environ.get("IMAGE_BUCKET")
 TABLE_NAME = os.environ.get("TABLE_NAME")
+AWS_REGION = os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION")
+# how many days of CreatedIndex buckets an unfiltered list walks back through at most
+LIST_LOOKBACK_DAYS = int(os.environ.get("LIST_LOOKBACK_DAYS", "30"))
+# how many of those day buckets are queried concurrently per round trip
+LIST_BUCKET_FANOUT = int(os.environ.get("LIST_BUCKET_FANOUT", "8"))
+# optional CloudFront distribution in front of the bucket, read through signed URLs;
+# the signing key is an SSM SecureString, never an env var
+CF_DOMAIN = os.environ.get("CF_DOMAIN")
+CF_KEY_PAIR_ID = os.environ.get("CF_KEY_PAIR_ID")
+CF_PRIVATE_KEY_PARAM = os.environ.get("CF_PRIVATE_KEY_PARAM")
 
-s3 = boto3.client("s3")
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(TABLE_NAME)
+# boto3 is imported and the clients built on first use, so cold starts that never
+# reach AWS (404s, invalid JSON, ...) don't pay for it
+_session = None
+_s3 = None
+_ddb = None
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        import boto3
+        _session = boto3.session.Session()
+    return _session
+
+
+def _client_config():
+    from botocore.config import Config
+    # Keep connections alive and pooled so warm invocations skip the TCP/TLS handshake
+    return Config(tcp_keepalive=True, max_pool_connections=50, retries={"mode": "standard", "max_attempts": 3})
+
+
+def _get_s3():
+    global _s3
+    if _s3 is None:
+        from botocore.config import Config
+        # Pin region and addressing style so the client doesn't have to work them out per call
+        _s3 = _get_session().client(
+            "s3",
+            region_name=AWS_REGION,
+            config=_client_config().merge(Config(signature_version="s3v4", s3={"addressing_style": "virtual"})),
+        )
+    return _s3
+
+
+def _get_ddb():
+    global _ddb
+    if _ddb is None:
+        # Low-level client: items come back as plain int/float/str rather than the resource API's Decimal
+        _ddb = _get_session().client("dynamodb", region_name=AWS_REGION, config=_client_config())
+    return _ddb
+
+
+# attributes returned by list_images
+_LIST_PROJECTION = "image_id, s3_key, user_id, created_at, tags"
+
+# /images and /images/{image_id}, with or without a stage/base path prefix
+_ROUTE = re.compile(r"/images(?:/(?P<id>[^/?]+))?/?$")
+
+# reused across invocations for work that can run side by side
+_EXEC = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+
+_Credentials = collections.namedtuple("_Credentials", "access_key secret_key token")
+
+
+def _credentials():
+    # Lambda hands the execution role's credentials over as env vars; use them directly
+    # instead of botocore's provider chain, and only fall back to boto3 outside Lambda
+    access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+    secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
+    if access_key and secret_key:
+        return _Credentials(access_key, secret_key, os.environ.get("AWS_SESSION_TOKEN"))
+    return _get_session().get_credentials().get_frozen_credentials()
+
+
+# derived SigV4 signing keys, keyed on (access_key, date, region, service)
+_signing_keys = {}
+
+
+def _signing_key(creds, date_stamp, region, service="s3"):
+    cache_key = (creds.access_key, date_stamp, region, service)
+    k = _signing_keys.get(cache_key)
+    if k is None:
+        k = hmac.new(("AWS4" + creds.secret_key).encode(), date_stamp.encode(), hashlib.sha256).digest()
+        for part in (region, service, "aws4_request"):
+            k = hmac.new(k, part.encode(), hashlib.sha256).digest()
+        if len(_signing_keys) > 8:
+            _signing_keys.clear()  # keys from earlier days or rotated credentials
+        _signing_keys[cache_key] = k
+    return k
+
+
+# Derive today's key during init; it is rebuilt lazily once the date rolls over
+if os.environ.get("AWS_ACCESS_KEY_ID") and os.environ.get("AWS_SECRET_ACCESS_KEY") and AWS_REGION:
+    _signing_key(_credentials(), time.strftime("%Y%m%d", time.gmtime()), AWS_REGION)
+
+
+def _to_ddb(value):
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, str):
+        return {"S": value}
+    if isinstance(value, (int, float)):
+        return {"N": str(value)}
+    if value is None:
+        return {"NULL": True}
+    if isinstance(value, dict):
+        return {"M": {k: _to_ddb(v) for k, v in value.items()}}
+    if isinstance(value, (set, frozenset)):
+        return {"SS": sorted(value)}
+    return {"L": [_to_ddb(v) for v in value]}
+
+
+def _number(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+def _from_ddb(value):
+    (kind, v), = value.items()
+    if kind == "S" or kind == "BOOL" or kind == "B":
+        return v
+    if kind == "N":
+        return _number(v)
+    if kind == "L":
+        return [_from_ddb(x) for x in v]
+    if kind == "M":
+        return {k: _from_ddb(x) for k, x in v.items()}
+    if kind == "SS" or kind == "BS":
+        return set(v)
+    if kind == "NS":
+        return {_number(x) for x in v}
+    return None  # NULL
+
+
+def _to_item(item):
+    return {k: _to_ddb(v) for k, v in item.items()}
+
+
+def _from_item(raw):
+    return {k: _from_ddb(v) for k, v in raw.items()}
+
+
+# Unprocessed batch items usually mean throttling: retry them with capped exponential backoff
+_BATCH_MAX_ATTEMPTS = 6
+_BATCH_BACKOFF_BASE = 0.05
+_BATCH_BACKOFF_CAP = 1.0
+
+
+def _batch_backoff(attempt):
+    if attempt >= _BATCH_MAX_ATTEMPTS:
+        raise RuntimeError(f"DynamoDB batch request still unprocessed after {attempt} attempts")
+    # "full jitter": sleep a random amount up to the capped exponential delay
+    time.sleep(random.uniform(0, min(_BATCH_BACKOFF_CAP, _BATCH_BACKOFF_BASE * 2 ** attempt)))
+
+
+def _batch_write(requests):
+    # BatchWriteItem takes at most 25 requests per call and may hand some back as unprocessed
+    for start in range(0, len(requests), 25):
+        pending = {TABLE_NAME: requests[start:start + 25]}
+        attempt = 0
+        while True:
+            pending = _get_ddb().batch_write_item(RequestItems=pending).get("UnprocessedItems")
+            if not pending:
+                break
+            attempt += 1
+            _batch_backoff(attempt)
+
+
+def _tag_row_id(image_id, tag):
+    # one row per (image, tag) feeds TagIndex; these rows carry no user_id so UserIndex stays sparse
+    return f"{image_id}#{tag}"
+
+
+def _is_tag_row_id(image_id):
+    # image ids are uuid hex and never contain '#'; ids that do address tag rows, not images
+    return "#" in image_id
+
+
+def _delete_tag_rows(image_id, tags):
+    _batch_write([{"DeleteRequest": {"Key": {"image_id": {"S": _tag_row_id(image_id, tag)}}}} for tag in set(tags)])
+
+
+def _ts_condition(values, fts, tts):
+    """Return a created_at range condition (or None), adding its placeholders to `values`."""
+    if fts is not None:
+        values[":from"] = {"N": str(fts)}
+    if tts is not None:
+        values[":to"] = {"N": str(tts)}
+    if fts is not None and tts is not None:
+        return "created_at BETWEEN :from AND :to"
+    if fts is not None:
+        return "created_at >= :from"
+    if tts is not None:
+        return "created_at <= :to"
+    return None
+
+
+def _query_pages(limit, resolve=None, **kwargs):
+    # Limit caps items *evaluated*, before any FilterExpression, so a single page can come back
+    # short; follow LastEvaluatedKey until `limit` items are collected or the query is exhausted.
+    # `resolve` maps each page to the items it yields, which may be fewer than it was given
+    items = []
+    while len(items) < limit:
+        resp = _get_ddb().query(TableName=TABLE_NAME, Limit=limit - len(items), **kwargs)
+        page = [_from_item(i) for i in resp.get("Items", [])]
+        items.extend(resolve(page) if resolve else page)
+        if "LastEvaluatedKey" not in resp:
+            break
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    return items
+
+
+def _batch_get_chunk(image_ids):
+    request = {TABLE_NAME: {"Keys": [{"image_id": {"S": i}} for i in image_ids], "ProjectionExpression": _LIST_PROJECTION}}
+    items = []
+    attempt = 0
+    while True:
+        resp = _get_ddb().batch_get_item(RequestItems=request)
+        items.extend(_from_item(raw) for raw in resp.get("Responses", {}).get(TABLE_NAME, []))
+        request = resp.get("UnprocessedKeys")
+        if not request:
+            return items
+        attempt += 1
+        _batch_backoff(attempt)
+
+
+def _batch_get(image_ids):
+    # BatchGetItem takes at most 100 keys per call; fetch the chunks concurrently
+    _get_ddb()  # build the client once before fanning out
+    chunks = [image_ids[start:start + 100] for start in range(0, len(image_ids), 100)]
+    found = {i["image_id"]: i for items in _EXEC.map(_batch_get_chunk, chunks) for i in items}
+    return [found[i] for i in image_ids if i in found]
+
+
+class _SignerContext:
+    """
+    SigV4 query-string presigning for objects in one bucket.
+
+    Credentials, timestamp, credential scope and the derived signing key are fixed
+    when the context is built; bind() then fixes method, expiry and signed headers and
+    returns a key -> URL callable that only does one SHA-256 and one HMAC per URL.
+    Signs exactly like botocore's generate_presigned_url, without going through
+    endpoint resolution, the serializer and the event system.
+    """
+
+    def __init__(self, bucket):
+        creds = _credentials()
+        self.amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        date_stamp = self.amz_date[:8]
+        self.host = f"{bucket}.s3.{AWS_REGION}.amazonaws.com"
+        self.credential_scope = f"{date_stamp}/{AWS_REGION}/s3/aws4_request"
+        self.k_signing = _signing_key(creds, date_stamp, AWS_REGION)
+        self.creds = creds
+
+    def bind(self, expires, method="GET", content_type=None):
+        if content_type:
+            signed_headers = "content-type;host"
+            canonical_headers = f"content-type:{content_type}\nhost:{self.host}\n"
+        else:
+            signed_headers = "host"
+            canonical_headers = f"host:{self.host}\n"
+
+        params = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{self.creds.access_key}/{self.credential_scope}",
+            "X-Amz-Date": self.amz_date,
+            "X-Amz-Expires": str(expires),
+            "X-Amz-SignedHeaders": signed_headers,
+        }
+        if self.creds.token:
+            params["X-Amz-Security-Token"] = self.creds.token
+        query = "&".join(f"{k}={quote(v, safe='-_.~')}" for k, v in sorted(params.items()))
+
+        request_head = f"{method}\n"
+        request_tail = f"\n{query}\n{canonical_headers}\n{signed_headers}\nUNSIGNED-PAYLOAD"
+        sts_head = f"AWS4-HMAC-SHA256\n{self.amz_date}\n{self.credential_scope}\n"
+        url_head = f"https://{self.host}"
+        url_tail = f"?{query}&X-Amz-Signature="
+        k_signing = self.k_signing
+
+        def sign(key):
+            canonical_uri = "/" + quote(key, safe="/~")
+            digest = hashlib.sha256(f"{request_head}{canonical_uri}{request_tail}".encode()).hexdigest()
+            signature = hmac.new(k_signing, (sts_head + digest).encode(), hashlib.sha256).hexdigest()
+            return f"{url_head}{canonical_uri}{url_tail}{signature}"
+
+        return sign
+
+
+def _presign(method, bucket, key, expires, content_type=None):
+    return _SignerContext(bucket).bind(expires, method, content_type)(key)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_signer(bucket, minute, expires):
+    # `minute` only takes part in the cache key: a bound signer (and its X-Amz-Date) lives for at most 60s
+    return _SignerContext(bucket).bind(expires)
+
+
+def _minute():
+    return int(time.time()) // 60
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_presign(key, bucket, minute):
+    # a 5 minute URL is reused for at most 60s
+    return _get_signer(bucket, minute, 300)(key)
+
+
+def _presign_get(key):
+    return _cached_presign(key, IMAGE_BUCKET, _minute())
+
+
+# CloudFront's URL-safe base64 alphabet
+_CF_B64 = bytes.maketrans(b"+=/", b"-_~")
+
+
+def _cf_b64(data):
+    return base64.b64encode(data).translate(_CF_B64).decode()
+
+
+@functools.lru_cache(maxsize=1)
+def _cf_private_key():
+    from cryptography.hazmat.primitives import serialization
+    pem = _get_session().client("ssm", region_name=AWS_REGION, config=_client_config()).get_parameter(
+        Name=CF_PRIVATE_KEY_PARAM, WithDecryption=True)["Parameter"]["Value"]
+    return serialization.load_pem_private_key(pem.encode(), password=None)
+
+
+@functools.lru_cache(maxsize=4)
+def _cf_signed_query(minute):
+    """
+    CloudFront signed-URL query string (custom policy) valid for any object in the
+    distribution until 5 minutes after `minute`.
+
+    The policy's wildcard resource lets the same Policy/Signature/Key-Pair-Id be
+    appended to every URL in every list response, so one RSA signature per minute
+    replaces a presign per item.
+    """
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    policy = orjson.dumps({"Statement": [{
+        "Resource": f"https://{CF_DOMAIN}/*",
+        "Condition": {"DateLessThan": {"AWS:EpochTime": minute * 60 + 300}},
+    }]})
+    # CloudFront only accepts RSA-SHA1 with PKCS#1 v1.5 padding
+    signature = _cf_private_key().sign(policy, padding.PKCS1v15(), hashes.SHA1())
+    return f"Policy={_cf_b64(policy)}&Signature={_cf_b64(signature)}&Key-Pair-Id={CF_KEY_PAIR_ID}"
+
+
+def _json_default(obj):
+    # string/number sets (e.g. tags) go out as sorted JSON arrays
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError
 
 
 def response(status_code, body):
-    return {"statusCode": status_code, "body": json.dumps(body), "headers": {"Content-Type": "application/json"}}
+    return {"statusCode": status_code, "body": orjson.dumps(body, default=_json_default).decode(),
+            "headers": {"Content-Type": "application/json"}}
+
+
+# responses with constant bodies are encoded once at import and returned as-is
+_NOT_FOUND = response(404, {"message": "Not Found"})
+_IMAGE_NOT_FOUND = response(404, {"message": "Image not found"})
+_INVALID_JSON = response(400, {"message": "Invalid JSON"})
+_MISSING_FIELDS = response(400, {"message": "user_id and filename are required"})
+_INVALID_TAGS = response(400, {"message": "tags must be a list of non-empty strings"})
+_INVALID_TS = response(400, {"message": "from_ts and to_ts must be integers"})
+_EMPTY_LIST = response(200, {"items": []})
 
 
 def lambda_handler(event, context):
     # API Gateway proxy event
-    http_method = event.get("httpMethod")
-    path = event.get("path", "")
-    raw_qs = event.get("queryStringParameters") or {}
-    path_params = event.get("pathParameters") or {}
-    body = event.get("body")
-    try:
-        if body and event.get("isBase64Encoded"):
-            # if base64, API expects presigned approach so usually not used
-            pass
-    except Exception:
-        pass
-
-    # Routing
-    if http_method == "POST" and path.endswith("/images"):
-        return create_image(event)
-    if http_method == "GET" and path.endswith("/images") and not path_params.get("image_id"):
-        return list_images(event)
-    # GET /images/{image_id}
-    if http_method == "GET" and "/images/" in path:
-        image_id = path.split("/images/")[-1]
-        image_id = unquote_plus(image_id)
-        return get_image(event, image_id)
-    # DELETE /images/{image_id}
-    if http_method == "DELETE" and "/images/" in path:
-        image_id = path.split("/images/")[-1]
-        image_id = unquote_plus(image_id)
-        return delete_image(event, image_id)
-
-    return response(404, {"message": "Not Found"})
-
-
-def create_image(event):
+    m = _ROUTE.search(event.get("path", ""))
+    if m:
+        image_id = unquote_plus(m.group("id")) if m.group("id") else None
+        handler = _DISPATCH.get((event.get("httpMethod"), image_id is not None))
+        if handler:
+            return handler(event, image_id)
+
+    return _NOT_FOUND
+
+
+def create_image(event, image_id=None):
     """
     Create an image metadata record and return a presigned PUT URL for the client to upload.
 
@@ -64,9 +416,9 @@ def create_image(event):
     }
     """
     try:
-        payload = json.loads(event.get("body") or "{}")
-    except json.JSONDecodeError:
-        return response(400, {"message": "Invalid JSON"})
+        payload = orjson.loads(event.get("body") or b"{}")
+    except orjson.JSONDecodeError:
+        return _INVALID_JSON
 
     user_id = payload.get("user_id")
     filename = payload.get("filename")
@@ -75,35 +427,40 @@ def create_image(event):
     description = payload.get("description", "")
 
     if not user_id or not filename:
-        return response(400, {"message": "user_id and filename are required"})
+        return _MISSING_FIELDS
+    # tags become TagIndex hash keys, which must be non-empty strings
+    if not isinstance(tags, list) or not all(isinstance(t, str) and t for t in tags):
+        return _INVALID_TAGS
+    tags = set(tags)
 
-    image_id = str(uuid.uuid4())
+    image_id = uuid.uuid4().hex
     key = f"{user_id}/{image_id}/{filename}"
 
     # store metadata in DynamoDB (object may be uploaded shortly after)
+    created_at = int(time.time())
     item = {
         "image_id": image_id,
         "user_id": user_id,
         "s3_key": key,
         "filename": filename,
         "content_type": content_type,
-        "tags": tags,
         "description": description,
-        "created_at": int(time.time())
+        "created_at": created_at,
+        "created_bucket": created_at // 86400  # day bucket for CreatedIndex
     }
-    table.put_item(Item=item)
+    if tags:
+        item["tags"] = tags  # string set; DynamoDB doesn't allow empty sets
+    rows = [item] + [{"image_id": _tag_row_id(image_id, tag), "image_ref": image_id, "tag": tag, "created_at": created_at}
+                     for tag in tags]
+    _batch_write([{"PutRequest": {"Item": _to_item(row)}} for row in rows])
 
     # generate presigned PUT URL
-    put_url = s3.generate_presigned_url(
-        ClientMethod="put_object",
-        Params={"Bucket": IMAGE_BUCKET, "Key": key, "ContentType": content_type},
-        ExpiresIn=900  # 15 minutes
-    )
+    put_url = _presign("PUT", IMAGE_BUCKET, key, 900, content_type=content_type)  # 15 minutes
 
     return response(201, {"image_id": image_id, "upload_url": put_url, "s3_key": key})
 
 
-def list_images(event):
+def list_images(event, image_id=None):
     """
     List images. Support filters via query params:
       - user_id
@@ -118,52 +475,107 @@ def list_images(event):
     to_ts = qs.get("to_ts")
     limit = int(qs.get("limit", "50"))
 
-    # If user_id provided, use GSI to query
-    items = []
+    try:
+        fts = int(from_ts) if from_ts else None
+        tts = int(to_ts) if to_ts else None
+    except ValueError:
+        return _INVALID_TS
+    # an inverted range matches nothing, and DynamoDB rejects BETWEEN with its bounds reversed
+    if fts is not None and tts is not None and fts > tts:
+        return _EMPTY_LIST
+
+    # tag and timestamp filters are evaluated by DynamoDB, not in memory
+    values = {}
+    ts_condition = _ts_condition(values, fts, tts)
     if user_id:
-        resp = table.query(IndexName="UserIndex", KeyConditionExpression=boto3.dynamodb.conditions.Key('user_id').eq(user_id), Limit=limit)
-        items = resp.get("Items", [])
+        values[":u"] = {"S": user_id}
+        kwargs = {"IndexName": "UserIndex", "KeyConditionExpression": "#u = :u",
+                  "ExpressionAttributeNames": {"#u": "user_id"}, "ProjectionExpression": _LIST_PROJECTION}
+        conditions = [c for c in ("contains(tags, :tag)" if tag else None, ts_condition) if c]
+        if tag:
+            values[":tag"] = {"S": tag}
+        if conditions:
+            kwargs["FilterExpression"] = " AND ".join(conditions)
+        items = _query_pages(limit, ExpressionAttributeValues=values, **kwargs)
+    elif tag:
+        values[":tag"] = {"S": tag}
+        key_condition = "tag = :tag" + (f" AND {ts_condition}" if ts_condition else "")
+        # newest first, like the unfiltered CreatedIndex walk; tag rows left behind by a failed
+        # delete resolve to nothing, so paging goes on until `limit` images are found
+        items = _query_pages(limit, resolve=lambda rows: _batch_get([i["image_ref"] for i in rows]),
+                             IndexName="TagIndex", KeyConditionExpression=key_condition,
+                             ExpressionAttributeValues=values, ScanIndexForward=False)
     else:
-        # scan (for demo; in prod use better patterns)
-        resp = table.scan(Limit=limit)
-        items = resp.get("Items", [])
-
-    # apply tag and timestamp filters in memory
-    if tag:
-        items = [i for i in items if tag in (i.get("tags") or [])]
-    if from_ts or to_ts:
-        try:
-            fts = int(from_ts) if from_ts else None
-            tts = int(to_ts) if to_ts else None
-            def in_range(i):
-                ca = int(i.get("created_at", 0))
-                if fts and ca < fts:
-                    return False
-                if tts and ca > tts:
-                    return False
-                return True
-            items = [i for i in items if in_range(i)]
-        except ValueError:
-            return response(400, {"message": "from_ts and to_ts must be integers"})
-
-    # For each item, add a 'download_url' (short-lived)
-    for i in items:
+        # newest first, one CreatedIndex day bucket at a time; nothing is newer than now, and the
+        # walk never spans more than LIST_LOOKBACK_DAYS buckets whatever from_ts/to_ts ask for
+        now = int(time.time())
+        upper = min(tts, now) if tts is not None else now
+        lower = upper - LIST_LOOKBACK_DAYS * 86400
+        if fts is not None:
+            lower = max(fts, lower)
+        if lower > upper:
+            return _EMPTY_LIST  # from_ts is still in the future (client clock ahead of ours)
+
+        def query_bucket(bucket, need):
+            return _query_pages(
+                need,
+                IndexName="CreatedIndex",
+                KeyConditionExpression="created_bucket = :b AND created_at BETWEEN :from AND :to",
+                ExpressionAttributeValues={":b": {"N": str(bucket)}, ":from": {"N": str(lower)}, ":to": {"N": str(upper)}},
+                ScanIndexForward=False,
+            )
+
+        # buckets are queried LIST_BUCKET_FANOUT at a time on _EXEC and merged newest bucket first,
+        # so a sparse window costs a few round trips rather than one per day
+        _get_ddb()  # build the client once before fanning out
+        buckets = list(range(upper // 86400, lower // 86400 - 1, -1))
+        items = []
+        for start in range(0, len(buckets), LIST_BUCKET_FANOUT):
+            need = limit - len(items)
+            wave = buckets[start:start + LIST_BUCKET_FANOUT]
+            for page in _EXEC.map(query_bucket, wave, [need] * len(wave)):
+                items += page
+            if len(items) >= limit:
+                del items[limit:]
+                break
+        # CreatedIndex only projects the list attributes; its bucket key is internal
+        for i in items:
+            i.pop("created_bucket", None)
+
+    # Behind CloudFront: CDN URLs sharing one signed policy query string
+    if CF_DOMAIN and CF_KEY_PAIR_ID and CF_PRIVATE_KEY_PARAM:
         try:
-            i["download_url"] = s3.generate_presigned_url("get_object", Params={"Bucket": IMAGE_BUCKET, "Key": i["s3_key"]}, ExpiresIn=300)
+            signed_query = _cf_signed_query(_minute())
         except Exception:
-            i["download_url"] = None
+            signed_query = None  # fall back to presigned S3 URLs below
+        if signed_query:
+            base = f"https://{CF_DOMAIN}/"
+            for i in items:
+                i["download_url"] = f"{base}{quote(i['s3_key'], safe='/~')}?{signed_query}" if "s3_key" in i else None
+            return response(200, {"items": items})
+
+    # For each item, add a 'download_url' (short-lived); one signer context serves the whole page
+    try:
+        sign = _get_signer(IMAGE_BUCKET, _minute(), 300)
+    except Exception:
+        sign = None
+    for i in items:
+        i["download_url"] = sign(i["s3_key"]) if sign and "s3_key" in i else None
 
     return response(200, {"items": items})
 
 
 def get_image(event, image_id):
     # fetch metadata, return presigned GET URL
-    resp = table.get_item(Key={"image_id": image_id})
-    item = resp.get("Item")
-    if not item:
-        return response(404, {"message": "Image not found"})
+    if _is_tag_row_id(image_id):
+        return _IMAGE_NOT_FOUND
+    resp = _get_ddb().get_item(TableName=TABLE_NAME, Key={"image_id": {"S": image_id}})
+    if "s3_key" not in resp.get("Item", {}):
+        return _IMAGE_NOT_FOUND
+    item = _from_item(resp["Item"])
+    item.pop("created_bucket", None)  # internal CreatedIndex key
     try:
-        url = s3.generate_presigned_url("get_object", Params={"Bucket": IMAGE_BUCKET, "Key": item["s3_key"]}, ExpiresIn=300)
+        url = _presign_get(item["s3_key"])
     except Exception as e:
         return response(500, {"message": "Could not generate URL", "error": str(e)})
 
@@ -172,19 +584,31 @@ def get_image(event, image_id):
 
 
 def delete_image(event, image_id):
-    # Get item
-    resp = table.get_item(Key={"image_id": image_id})
-    item = resp.get("Item")
-    if not item:
-        return response(404, {"message": "Image not found"})
-
-    # Delete object from S3
-    try:
-        s3.delete_object(Bucket=IMAGE_BUCKET, Key=item["s3_key"])
-    except Exception as e:
-        # continue to remove metadata, but report
-        pass
+    if _is_tag_row_id(image_id):
+        return _IMAGE_NOT_FOUND
+    # Delete the metadata and get it back in the same round trip
+    resp = _get_ddb().delete_item(TableName=TABLE_NAME, Key={"image_id": {"S": image_id}}, ReturnValues="ALL_OLD")
+    if not resp.get("Attributes"):
+        return _IMAGE_NOT_FOUND
+    item = _from_item(resp["Attributes"])
 
-    # Delete from DynamoDB
-    table.delete_item(Key={"image_id": image_id})
+    # The S3 object and the TagIndex rows are independent, remove them side by side
+    s3_future = _EXEC.submit(_get_s3().delete_object, Bucket=IMAGE_BUCKET, Key=item.get("s3_key"))
+    tags_future = _EXEC.submit(_delete_tag_rows, image_id, item.get("tags") or [])
+    # metadata is already gone, so neither failure is worth failing the request over:
+    # a leftover object is just unreferenced, and the tag listing pages past orphaned tag rows
+    for future in (s3_future, tags_future):
+        try:
+            future.result()
+        except Exception:
+            pass
     return response(200, {"message": "Deleted", "image_id": image_id})
+
+
+# (method, has image_id) -> handler(event, image_id)
+_DISPATCH = {
+    ("POST", False): create_image,
+    ("GET", False): list_images,
+    ("GET", True): get_image,
+    ("DELETE", True): delete_image,
+}
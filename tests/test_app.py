@@ -1,14 +1,26 @@
 import os
 import json
 import time
+import base64
+import datetime
 import boto3
 import pytest
-from moto import mock_s3, mock_dynamodb2
-from src import app as image_app
+from unittest import mock
+from urllib.parse import urlsplit, parse_qs
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from moto import mock_s3, mock_dynamodb2, mock_ssm
 
 TEST_BUCKET = "test-bucket"
 TEST_TABLE = "test-table"
 
+# the handler reads its configuration at import; clients are only built once inside the mocks
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("IMAGE_BUCKET", TEST_BUCKET)
+os.environ.setdefault("TABLE_NAME", TEST_TABLE)
+
+from src import app as image_app
+
 
 @pytest.fixture(autouse=True)
 def aws_creds():
@@ -32,12 +44,25 @@ def aws_resources():
                 TableName=TEST_TABLE,
                 KeySchema=[{"AttributeName": "image_id", "KeyType": "HASH"}],
                 AttributeDefinitions=[{"AttributeName": "image_id", "AttributeType": "S"},
-                                      {"AttributeName": "user_id", "AttributeType": "S"}],
+                                      {"AttributeName": "user_id", "AttributeType": "S"},
+                                      {"AttributeName": "tag", "AttributeType": "S"},
+                                      {"AttributeName": "created_at", "AttributeType": "N"},
+                                      {"AttributeName": "created_bucket", "AttributeType": "N"}],
                 BillingMode="PAY_PER_REQUEST",
                 GlobalSecondaryIndexes=[{
                     "IndexName": "UserIndex",
                     "KeySchema": [{"AttributeName": "user_id", "KeyType": "HASH"}],
                     "Projection": {"ProjectionType": "ALL"},
+                }, {
+                    "IndexName": "TagIndex",
+                    "KeySchema": [{"AttributeName": "tag", "KeyType": "HASH"},
+                                  {"AttributeName": "created_at", "KeyType": "RANGE"}],
+                    "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["image_ref"]},
+                }, {
+                    "IndexName": "CreatedIndex",
+                    "KeySchema": [{"AttributeName": "created_bucket", "KeyType": "HASH"},
+                                  {"AttributeName": "created_at", "KeyType": "RANGE"}],
+                    "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["s3_key", "user_id", "tags"]},
                 }],
             )
             table.wait_until_exists()
@@ -79,8 +104,15 @@ def test_create_and_get_and_delete(aws_resources):
     assert get_resp["statusCode"] == 200
     gbody = json.loads(get_resp["body"])
     assert gbody["image_id"] == image_id
+    assert gbody["tags"] == ["t1", "t2"]
+    assert "created_bucket" not in gbody
     assert "download_url" in gbody
 
+    # TagIndex rows share the key space but aren't images
+    tag_row_event = {"httpMethod": "GET", "path": f"/images/{image_id}%23t1", "queryStringParameters": None}
+    assert image_app.lambda_handler(tag_row_event, None)["statusCode"] == 404
+    assert image_app.lambda_handler(dict(tag_row_event, httpMethod="DELETE"), None)["statusCode"] == 404
+
     # Delete
     del_event = {"httpMethod": "DELETE", "path": f"/images/{image_id}", "pathParameters": {"image_id": image_id}}
     del_resp = image_app.lambda_handler(del_event, None)
@@ -90,6 +122,12 @@ def test_create_and_get_and_delete(aws_resources):
     get_resp2 = image_app.lambda_handler(get_event, None)
     assert get_resp2["statusCode"] == 404
 
+    # ...and its TagIndex rows went with it
+    tag_rows = boto3.client("dynamodb").query(
+        TableName=TEST_TABLE, IndexName="TagIndex", KeyConditionExpression="tag = :t",
+        ExpressionAttributeValues={":t": {"S": "t1"}})["Items"]
+    assert tag_rows == []
+
 
 def test_list_and_filters(aws_resources):
     # create several images
@@ -126,3 +164,199 @@ def test_list_and_filters(aws_resources):
     items2 = json.loads(list_resp2["body"])["items"]
     assert len(items2) == 1
     assert items2[0]["user_id"] == "userB"
+
+    # Tag combined with a time range goes through TagIndex's sort key
+    list_event3 = {"httpMethod": "GET", "path": "/images",
+                   "queryStringParameters": {"tag": "sun", "from_ts": str(now - 60)}}
+    items3 = json.loads(image_app.lambda_handler(list_event3, None)["body"])["items"]
+    assert sorted(i["image_id"] for i in items3) == sorted(ids[:2])
+    list_event4 = {"httpMethod": "GET", "path": "/images",
+                   "queryStringParameters": {"tag": "sun", "to_ts": str(now - 60)}}
+    assert json.loads(image_app.lambda_handler(list_event4, None)["body"])["items"] == []
+
+    # Unfiltered listing walks CreatedIndex and honours limit
+    list_event5 = {"httpMethod": "GET", "path": "/images", "queryStringParameters": None}
+    assert len(json.loads(image_app.lambda_handler(list_event5, None)["body"])["items"]) == 3
+    list_event6 = {"httpMethod": "GET", "path": "/images", "queryStringParameters": {"limit": "2"}}
+    assert len(json.loads(image_app.lambda_handler(list_event6, None)["body"])["items"]) == 2
+
+
+def test_presign_matches_botocore(aws_resources):
+    fixed = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    creds = image_app._credentials()
+    client = boto3.client("s3", region_name=image_app.AWS_REGION,
+                          aws_access_key_id=creds.access_key, aws_secret_access_key=creds.secret_key,
+                          aws_session_token=creds.token,
+                          endpoint_url=f"https://s3.{image_app.AWS_REGION}.amazonaws.com",
+                          config=Config(signature_version="s3v4", s3={"addressing_style": "virtual"}))
+    key = "u1/abc/my pic+1.jpg"
+    with mock.patch("botocore.auth.get_current_datetime", return_value=fixed), \
+            mock.patch.object(image_app.time, "gmtime", return_value=fixed.timetuple()):
+        expected = client.generate_presigned_url(
+            "put_object", Params={"Bucket": image_app.IMAGE_BUCKET, "Key": key, "ContentType": "image/jpeg"}, ExpiresIn=900)
+        url = image_app._presign("PUT", image_app.IMAGE_BUCKET, key, 900, content_type="image/jpeg")
+
+    assert urlsplit(url)[:3] == urlsplit(expected)[:3]
+    assert parse_qs(urlsplit(url).query) == parse_qs(urlsplit(expected).query)
+
+
+def test_ddb_item_round_trip(aws_resources):
+    item = {"image_id": "i1", "created_at": 1700000000, "ratio": 1.5, "tags": ["a", "b"],
+            "meta": {"w": 10, "ok": True}, "note": None}
+    raw = image_app._to_item(item)
+    assert raw["created_at"] == {"N": "1700000000"}
+    assert image_app._from_item(raw) == item
+    assert image_app._from_ddb({"NS": ["1", "2.5"]}) == {1, 2.5}
+    assert image_app._to_ddb({"b", "a"}) == {"SS": ["a", "b"]}
+    assert image_app._from_ddb({"SS": ["a", "b"]}) == {"a", "b"}
+
+
+def test_list_with_cloudfront_signed_urls(aws_resources, monkeypatch):
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, padding
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode()
+    with mock_ssm():
+        boto3.client("ssm").put_parameter(Name="/images/cf-key", Value=pem, Type="SecureString")
+        monkeypatch.setattr(image_app, "CF_DOMAIN", "d111.cloudfront.net")
+        monkeypatch.setattr(image_app, "CF_KEY_PAIR_ID", "K123")
+        monkeypatch.setattr(image_app, "CF_PRIVATE_KEY_PARAM", "/images/cf-key")
+        image_app._cf_private_key.cache_clear()
+        image_app._cf_signed_query.cache_clear()
+
+        event = {"httpMethod": "POST", "path": "/images", "body": json.dumps({"user_id": "u1", "filename": "a b.jpg"})}
+        image_id = json.loads(image_app.lambda_handler(event, None)["body"])["image_id"]
+
+        list_event = {"httpMethod": "GET", "path": "/images", "queryStringParameters": {"user_id": "u1"}}
+        items = json.loads(image_app.lambda_handler(list_event, None)["body"])["items"]
+    image_app._cf_private_key.cache_clear()
+    image_app._cf_signed_query.cache_clear()
+
+    url = urlsplit(items[0]["download_url"])
+    assert (url.scheme, url.netloc, url.path) == ("https", "d111.cloudfront.net", f"/u1/{image_id}/a%20b.jpg")
+    params = {k: v[0] for k, v in parse_qs(url.query).items()}
+    assert params["Key-Pair-Id"] == "K123"
+    unb64 = lambda v: base64.b64decode(v.translate(str.maketrans("-_~", "+=/")))
+    policy = unb64(params["Policy"])
+    assert json.loads(policy)["Statement"][0]["Resource"] == "https://d111.cloudfront.net/*"
+    key.public_key().verify(unb64(params["Signature"]), policy, padding.PKCS1v15(), hashes.SHA1())
+
+
+def test_batch_write_backs_off_then_gives_up(aws_resources):
+    unprocessed = {"UnprocessedItems": {TEST_TABLE: [{"PutRequest": {"Item": {"image_id": {"S": "x"}}}}]}}
+    ddb = mock.Mock()
+    ddb.batch_write_item.return_value = unprocessed
+    with mock.patch.object(image_app, "_get_ddb", return_value=ddb), \
+            mock.patch.object(image_app.time, "sleep") as sleep:
+        with pytest.raises(RuntimeError):
+            image_app._batch_write([{"PutRequest": {"Item": {"image_id": {"S": "x"}}}}])
+    assert ddb.batch_write_item.call_count == image_app._BATCH_MAX_ATTEMPTS
+    assert sleep.call_count == image_app._BATCH_MAX_ATTEMPTS - 1
+    assert all(0 <= c.args[0] <= image_app._BATCH_BACKOFF_CAP for c in sleep.call_args_list)
+
+
+def test_unfiltered_list_walk_is_bounded(aws_resources):
+    with mock.patch.object(image_app, "_query_pages", wraps=image_app._query_pages) as pages:
+        for qs in ({"from_ts": "1"}, {"from_ts": "-99999999999"}, {"to_ts": "99999999999"},
+                   {"from_ts": "1", "to_ts": "99999999999"}):
+            pages.reset_mock()
+            resp = image_app.lambda_handler({"httpMethod": "GET", "path": "/images", "queryStringParameters": qs}, None)
+            assert resp["statusCode"] == 200
+            assert pages.call_count <= image_app.LIST_LOOKBACK_DAYS + 1
+
+
+def test_filtered_user_query_pages_until_limit(aws_resources):
+    # DynamoDB applies Limit before FilterExpression, so a filtered page can come back empty with more to read.
+    # moto filters first, so script the pages the real service returns.
+    match = {"image_id": {"S": "i9"}, "s3_key": {"S": "u1/i9/9.jpg"}, "user_id": {"S": "u1"},
+             "created_at": {"N": "1700000000"}, "tags": {"SS": ["want"]}}
+    pages = [{"Items": [], "LastEvaluatedKey": {"image_id": {"S": f"i{n}"}, "user_id": {"S": "u1"}}} for n in range(3)]
+    pages.append({"Items": [match], "LastEvaluatedKey": {"image_id": {"S": "i9"}, "user_id": {"S": "u1"}}})
+    ddb = image_app._get_ddb()
+    list_event = {"httpMethod": "GET", "path": "/images",
+                  "queryStringParameters": {"user_id": "u1", "tag": "want", "limit": "1"}}
+    with mock.patch.object(ddb, "query", side_effect=pages) as query:
+        items = json.loads(image_app.lambda_handler(list_event, None)["body"])["items"]
+
+    assert [i["image_id"] for i in items] == ["i9"]
+    assert query.call_count == 4
+    assert "ExclusiveStartKey" not in query.call_args_list[0].kwargs
+    assert query.call_args_list[3].kwargs["ExclusiveStartKey"] == {"image_id": {"S": "i2"}, "user_id": {"S": "u1"}}
+    assert query.call_args_list[3].kwargs["FilterExpression"] == "contains(tags, :tag)"
+
+
+def test_create_rejects_invalid_tags(aws_resources):
+    for tags in ["beach", [1], [""], ["ok", ""]]:
+        event = {"httpMethod": "POST", "path": "/images",
+                 "body": json.dumps({"user_id": "u1", "filename": "a.jpg", "tags": tags})}
+        assert image_app.lambda_handler(event, None)["statusCode"] == 400
+
+
+def _strict_between(query):
+    # real DynamoDB fails a BETWEEN whose lower bound exceeds its upper bound; moto answers it
+    def strict(**kwargs):
+        values = kwargs.get("ExpressionAttributeValues", {})
+        if ":from" in values and ":to" in values and int(values[":from"]["N"]) > int(values[":to"]["N"]):
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "Invalid KeyConditionExpression"}},
+                              "Query")
+        return query(**kwargs)
+    return strict
+
+
+def test_list_inverted_range_is_empty(aws_resources):
+    ddb = image_app._get_ddb()
+    with mock.patch.object(ddb, "query", side_effect=_strict_between(ddb.query)):
+        for qs in ({"from_ts": "200", "to_ts": "100"}, {"tag": "x", "from_ts": "200", "to_ts": "100"},
+                   {"user_id": "u", "from_ts": "200", "to_ts": "100"}, {"from_ts": str(int(time.time()) + 5)}):
+            resp = image_app.lambda_handler({"httpMethod": "GET", "path": "/images", "queryStringParameters": qs}, None)
+            assert resp["statusCode"] == 200
+            assert json.loads(resp["body"])["items"] == []
+
+
+def test_tag_list_is_newest_first(aws_resources):
+    now = int(time.time())
+    ids = []
+    for offset in (300, 200, 100):
+        event = {"httpMethod": "POST", "path": "/images",
+                 "body": json.dumps({"user_id": "u1", "filename": "a.jpg", "tags": ["sun"]})}
+        with mock.patch.object(image_app.time, "time", return_value=now - offset):
+            ids.append(json.loads(image_app.lambda_handler(event, None)["body"])["image_id"])
+
+    list_event = {"httpMethod": "GET", "path": "/images", "queryStringParameters": {"tag": "sun", "limit": "2"}}
+    items = json.loads(image_app.lambda_handler(list_event, None)["body"])["items"]
+    assert [i["image_id"] for i in items] == ids[:0:-1]
+
+
+def test_tag_list_pages_past_orphaned_tag_rows(aws_resources):
+    now = int(time.time())
+    ids = []
+    for offset in (300, 200, 100):
+        event = {"httpMethod": "POST", "path": "/images",
+                 "body": json.dumps({"user_id": "u1", "filename": "a.jpg", "tags": ["sun"]})}
+        with mock.patch.object(image_app.time, "time", return_value=now - offset):
+            ids.append(json.loads(image_app.lambda_handler(event, None)["body"])["image_id"])
+    # a delete whose tag-row cleanup failed leaves the newest image's metadata gone and its tag row behind
+    boto3.client("dynamodb").delete_item(TableName=TEST_TABLE, Key={"image_id": {"S": ids[2]}})
+
+    list_event = {"httpMethod": "GET", "path": "/images", "queryStringParameters": {"tag": "sun", "limit": "2"}}
+    items = json.loads(image_app.lambda_handler(list_event, None)["body"])["items"]
+    assert [i["image_id"] for i in items] == [ids[1], ids[0]]
+
+
+def test_unfiltered_list_merges_buckets_newest_first(aws_resources):
+    now = int(time.time())
+    ids = []
+    for days in (10, 5, 2, 0):
+        event = {"httpMethod": "POST", "path": "/images",
+                 "body": json.dumps({"user_id": "u1", "filename": "a.jpg"})}
+        with mock.patch.object(image_app.time, "time", return_value=now - days * 86400):
+            ids.append(json.loads(image_app.lambda_handler(event, None)["body"])["image_id"])
+
+    with mock.patch.object(image_app, "_query_pages", wraps=image_app._query_pages) as pages:
+        list_event = {"httpMethod": "GET", "path": "/images", "queryStringParameters": {"limit": "3"}}
+        items = json.loads(image_app.lambda_handler(list_event, None)["body"])["items"]
+    assert [i["image_id"] for i in items] == ids[:0:-1]
+    # the three newest fall within the first wave of buckets, so the walk stops there
+    assert pages.call_count == image_app.LIST_BUCKET_FANOUT